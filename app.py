@@ -2,11 +2,14 @@ import streamlit as st
 import pandas as pd
 import re
 import io
+import os
+import hashlib
 from PIL import Image
 import numpy as np
-import fitz  # PyMuPDF
 from datetime import datetime
 import gc
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # Configuração da página
 st.set_page_config(
@@ -15,10 +18,95 @@ st.set_page_config(
     layout="wide"
 )
 
-# Inicialização do session state
-if 'ocr_reader' not in st.session_state:
-    st.session_state.ocr_reader = None
+# Inicialização do session state (o leitor OCR em si fica no cache_resource)
+if 'ocr_loaded' not in st.session_state:
     st.session_state.ocr_loaded = False
+if 'results_cache' not in st.session_state:
+    # Campos já extraídos nesta sessão, por hash do conteúdo: ficam só na
+    # sessão do usuário e somem com ela
+    st.session_state.results_cache = OrderedDict()
+if 'excel_cache' not in st.session_state:
+    # Último Excel gerado nesta sessão, com o hash da tabela que o originou
+    st.session_state.excel_cache = None
+
+# Colunas da tabela de resultados, na ordem de exibição
+COLUNAS = ['Arquivo', '1 - Registro ANS', '2 - Número GUIA', '4 - Data de Autorização', '10 - Nome']
+
+
+def available_cpus():
+    """Núcleos disponíveis para o app, respeitando a cota do container (cgroup)"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    # cgroup v2 ("max 100000" quando não há limite) e cgroup v1
+    quota_files = [('/sys/fs/cgroup/cpu.max', None),
+                   ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us')]
+    for quota_path, period_path in quota_files:
+        try:
+            with open(quota_path) as f:
+                values = f.read().split()
+            if period_path:
+                with open(period_path) as f:
+                    values.append(f.read().strip())
+            quota, period = values[0], int(values[1])
+            if quota != 'max' and int(quota) > 0 and period > 0:
+                cpus = min(cpus, max(1, int(quota) // period))
+                break
+        except (OSError, ValueError, IndexError):
+            continue
+    return max(1, cpus)
+
+
+# Núcleos que o app pode usar de fato
+CPU_COUNT = available_cpus()
+
+# Número de páginas enviadas ao OCR em paralelo: no máximo 2, para que
+# um único job ainda tenha vários núcleos para o torch
+OCR_WORKERS = 2 if CPU_COUNT >= 4 else 1
+
+# Threads do torch: o limite vale para o processo inteiro, então cada
+# página em paralelo fica com a metade dos núcleos (ou todos, com 1 worker)
+OCR_THREADS = max(1, CPU_COUNT // OCR_WORKERS)
+
+# Linhas de texto de uma página reconhecidas juntas pelo EasyOCR
+OCR_BATCH_SIZE = 8
+
+# Quantidade de arquivos mantidos no cache de resultados de cada sessão
+RESULTS_CACHE_SIZE = 64
+
+# RegEx dos campos, compiladas uma única vez e testadas em ordem de prioridade.
+# As de ANS e de data só têm ASCII: re.ASCII evita as tabelas Unicode de
+# maiúsculas/minúsculas e de dígitos (o texto já chega com espaços simples)
+ANS_PATTERNS = tuple(re.compile(p, re.IGNORECASE | re.ASCII) for p in (
+    r'(?:Registro\s+ANS|ANS)[:\s]*([0-9]{5,7})',
+    r'(?:^|\s)([0-9]{6})(?:\s|$)',
+))
+GUIA_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r'(?:N[úu]mero\s+(?:da\s+)?GUIA|GUIA\s+N)[:\s]*([0-9]{10,20})',
+    r'(?:N[°º]\s*Guia)[:\s]*([0-9]{10,20})',
+    r'(?:GUIA)[:\s]+([0-9]{10,20})',
+))
+NOME_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r'(?:10\s*[-.\s]*Nome)[:\s]*([A-ZÀÁÂÃÄÅÇÈÉÊËÌÍÎÏÑÒÓÔÕÖÙÚÛÜ][A-ZÀÁÂÃÄÅÇÈÉÊËÌÍÎÏÑÒÓÔÕÖÙÚÛÜ\s]{2,50})',
+    r'(?:Nome\s+(?:do\s+)?(?:Benefici[áa]rio|Paciente))[:\s]*([A-ZÀÁÂÃÄÅÇÈÉÊËÌÍÎÏÑÒÓÔÕÖÙÚÛÜ][A-ZÀÁÂÃÄÅÇÈÉÊËÌÍÎÏÑÒÓÔÕÖÙÚÛÜ\s]{2,50})',
+    r'(?:Benefici[áa]rio)[:\s]*([A-ZÀÁÂÃÄÅÇÈÉÊËÌÍÎÏÑÒÓÔÕÖÙÚÛÜ][A-ZÀÁÂÃÄÅÇÈÉÊËÌÍÎÏÑÒÓÔÕÖÙÚÛÜ\s]{2,50})',
+))
+
+# Datas no formato dd/mm/aaaa (ou dd-mm-aaaa)
+DATE_RE = re.compile(r'([0-3]?[0-9][/-][0-1]?[0-9][/-][0-9]{4})', re.ASCII)
+# Rótulo "Autorização" (com "Data de" opcional) e o separador até a data
+AUTORIZACAO_RE = re.compile(r'(Data\s+(?:de\s+)?)?Autoriza[çc][ãa]o[:\s]*', re.IGNORECASE)
+
+# Rótulos exigidos pelas RegEx de cada campo: sem eles a busca é pulada
+GUIA_ANCHORS = ('guia',)
+NOME_ANCHORS = ('nome', 'benefici')
+
+# Palavras de rótulos que costumam vir logo após o nome do beneficiário
+NOME_STOPWORDS = frozenset({
+    'cpf', 'rg', 'cns', 'cart', 'carteira', 'cartão', 'cartao', 'data',
+    'nascimento', 'sexo', 'plano', 'validade', 'nome', 'social',
+})
 
 
 @st.cache_resource(show_spinner=False)
@@ -26,15 +114,20 @@ def load_easyocr():
     """Carrega o modelo EasyOCR apenas uma vez e mantém em cache"""
     try:
         import easyocr
-        # Configuração otimizada para Streamlit Cloud
+        import torch
+        # Divide os núcleos entre as páginas em paralelo (ver OCR_THREADS)
+        torch.set_num_threads(OCR_THREADS)
+        # Configuração otimizada para Streamlit Cloud (CPU), usando a GPU
+        # quando o servidor tiver CUDA disponível
         reader = easyocr.Reader(
             ['pt'], 
-            gpu=False,
+            gpu=torch.cuda.is_available(),
             verbose=False,
             download_enabled=True,
             model_storage_directory=None,
             detect_network='craft',
-            recog_network='standard'
+            recog_network='standard',
+            quantize=True  # Reconhecedor em int8 quando roda na CPU
         )
         return reader
     except Exception as e:
@@ -42,60 +135,135 @@ def load_easyocr():
         return None
 
 
-def extract_text_from_image(image):
-    """Extrai texto de uma imagem usando EasyOCR"""
-    try:
-        # Carrega o OCR se necessário
-        if st.session_state.ocr_reader is None:
-            with st.spinner("🔄 Inicializando modelo OCR... (pode levar 1-2 minutos na primeira vez)"):
-                st.session_state.ocr_reader = load_easyocr()
-                if st.session_state.ocr_reader is None:
-                    return ""
-                st.session_state.ocr_loaded = True
-        
-        # Redimensiona imagem se for muito grande
-        max_size = 2000
-        if max(image.size) > max_size:
-            ratio = max_size / max(image.size)
-            new_size = tuple([int(dim * ratio) for dim in image.size])
-            image = image.resize(new_size, Image.Resampling.LANCZOS)
-        
-        # Converte para RGB se necessário
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Converte PIL Image para numpy array
-        img_array = np.array(image)
-        
-        # Executa OCR com configurações otimizadas
-        results = st.session_state.ocr_reader.readtext(
-            img_array,
-            detail=0,  # Retorna apenas texto, sem coordenadas
-            paragraph=False,
-            batch_size=1
-        )
-        
-        # Concatena todos os textos extraídos
-        text = ' '.join(results) if results else ""
-        
-        # Libera memória
-        del img_array
-        gc.collect()
-        
-        return text
-        
-    except Exception as e:
-        st.error(f"Erro ao extrair texto da imagem: {str(e)}")
-        return ""
+@st.cache_resource(show_spinner=False)
+def get_ocr_executor():
+    """Cria o pool de threads do OCR apenas uma vez e o compartilha entre execuções"""
+    return ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix='ocr')
 
 
-def extract_text_from_pdf(pdf_file):
-    """Extrai texto de um arquivo PDF usando PyMuPDF e OCR"""
+def cache_results(file_hash, data):
+    """Guarda os campos de um arquivo na sessão, descartando os usados há mais tempo"""
+    results_cache = st.session_state.results_cache
+    results_cache[file_hash] = data
+    while len(results_cache) > RESULTS_CACHE_SIZE:
+        results_cache.popitem(last=False)
+
+
+def get_ocr_reader():
+    """Retorna o leitor OCR compartilhado, carregando o modelo na primeira chamada"""
+    if st.session_state.ocr_loaded:
+        return load_easyocr()
+    
+    with st.spinner("🔄 Inicializando modelo OCR... (pode levar 1-2 minutos na primeira vez)"):
+        reader = load_easyocr()
+    st.session_state.ocr_loaded = reader is not None
+    return reader
+
+
+def ocr_image(image, reader):
+    """Executa o OCR de uma imagem (não usa o Streamlit, pode rodar em outra thread)"""
+    import cv2
+    
+    max_size = 2000
+    
+    # Fotos JPEG já são decodificadas em tons de cinza e, se forem grandes,
+    # reduzidas pela escala do próprio JPEG (não afeta PNG nem páginas de PDF)
+    ratio = min(1, max_size / max(image.size))
+    image.draft('L', tuple([max(1, int(dim * ratio)) for dim in image.size]))
+    
+    # Converte para tons de cinza antes de redimensionar: 1 canal em vez de 3
+    # (as páginas de PDF já chegam em tons de cinza)
+    if image.mode != 'L':
+        image = image.convert('L')
+    
+    # Redimensiona imagem se for muito grande
+    if max(image.size) > max_size:
+        ratio = max_size / max(image.size)
+        new_size = tuple([max(1, int(dim * ratio)) for dim in image.size])
+        image = image.resize(new_size, Image.Resampling.LANCZOS)
+    
+    # Binariza com limiar adaptativo: melhora o contraste de guias digitalizadas
+    img_array = cv2.adaptiveThreshold(
+        np.asarray(image),
+        255,
+        cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+        cv2.THRESH_BINARY,
+        31,
+        10
+    )
+    
+    # Executa OCR com configurações otimizadas
+    results = reader.readtext(
+        img_array,
+        detail=0,  # Retorna apenas texto, sem coordenadas
+        paragraph=False,
+        batch_size=OCR_BATCH_SIZE  # Linhas reconhecidas por chamada do modelo
+    )
+    
+    # Concatena todos os textos extraídos
+    text = ' '.join(results) if results else ""
+    
+    # Libera memória (a coleta de ciclos roda uma vez, ao fim do lote)
+    del img_array
+    
+    return text
+
+
+def submit_ocr(image, pending):
+    """Envia a imagem ao pool de OCR e retorna o Future com o texto"""
+    # Limita a quantidade de imagens aguardando OCR em memória
+    if len(pending) >= OCR_WORKERS:
+        wait(pending, return_when=FIRST_COMPLETED)
+        pending.difference_update([future for future in pending if future.done()])
+    
+    future = get_ocr_executor().submit(ocr_image, image, get_ocr_reader())
+    pending.add(future)
+    return future
+
+
+def queue_image_ocr(image_bytes, pending):
+    """Envia um arquivo de imagem ao OCR e retorna as partes do seu texto"""
+    # Carrega o OCR se necessário
+    if get_ocr_reader() is None:
+        return [""]
+    
+    return [submit_ocr(Image.open(io.BytesIO(image_bytes)), pending)]
+
+
+def page_zoom(images, page_rect):
+    """Zoom de renderização da página: até 2x, sem passar da resolução da digitalização"""
+    # Sem imagens (ex.: texto convertido em curvas), usa o zoom padrão
+    if not images:
+        return 2
+    
+    # Usa a maior imagem da página (normalmente a própria digitalização)
+    def area(info):
+        return (page_rect & info['bbox']).get_area()
+    
+    info = max(images, key=area)
+    
+    # Só uma digitalização que cobre a maior parte da página define a
+    # resolução: um logotipo pequeno não diz nada sobre o resto do conteúdo
+    if area(info) < 0.6 * page_rect.get_area():
+        return 2
+    
+    x0, y0, x1, y1 = info['bbox']
+    lado = max(x1 - x0, y1 - y0)
+    
+    # Pixels da imagem por ponto da página: renderizar acima disso só
+    # interpola pixels e deixa o OCR mais lento. O mínimo de 1.5x mantém
+    # legível a letra miúda de digitalizações em baixa resolução
+    return min(2, max(1.5, max(info['width'], info['height']) / lado))
+
+
+def queue_pdf_ocr(pdf_bytes, filename, pending):
+    """Extrai o texto digital do PDF e envia as páginas escaneadas ao OCR"""
+    import fitz  # PyMuPDF
+    
+    pdf_document = None
     try:
-        pdf_bytes = pdf_file.read()
         pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
         
-        full_text = ""
         total_pages = len(pdf_document)
         
         # Limita a 10 páginas para evitar timeout
@@ -106,6 +274,11 @@ def extract_text_from_pdf(pdf_file):
         progress_bar = st.progress(0)
         status_text = st.empty()
         
+        # Texto de cada página, ou o Future do OCR ainda em andamento
+        parts = []
+        
+        # O PyMuPDF não é thread-safe: a renderização fica nesta thread e
+        # apenas o OCR roda no pool, sobrepondo a página N+1 ao OCR da página N
         for page_num in range(max_pages):
             status_text.text(f"📄 Processando página {page_num + 1} de {max_pages}...")
             
@@ -116,47 +289,96 @@ def extract_text_from_pdf(pdf_file):
                 page_text = page.get_text()
                 
                 # Se não houver texto suficiente, usa OCR
-                if len(page_text.strip()) < 50:
-                    # Converte página para imagem com zoom 2x
-                    mat = fitz.Matrix(2, 2)
-                    pix = page.get_pixmap(matrix=mat)
-                    img_data = pix.tobytes("png")
-                    img = Image.open(io.BytesIO(img_data))
-                    
-                    # Extrai texto via OCR
-                    page_text = extract_text_from_image(img)
+                if len(page_text.strip()) >= 50:
+                    parts.append(page_text)
+                else:
+                    # Imagens exibidas na página, inclusive as embutidas no
+                    # conteúdo (BI ... ID ... EI), que get_images não lista
+                    images = page.get_image_info()
                     
-                    # Libera memória
-                    del pix, img_data, img
-                    gc.collect()
+                    if not images and not page.get_cdrawings():
+                        # Página sem imagens nem desenhos (em branco): o OCR
+                        # não encontraria nada além do texto digital
+                        parts.append(page_text)
+                    elif get_ocr_reader() is None:
+                        parts.append("")
+                    else:
+                        # Converte página para imagem em tons de cinza, com zoom
+                        # conforme a resolução da digitalização
+                        zoom = page_zoom(images, page.rect)
+                        mat = fitz.Matrix(zoom, zoom)
+                        pix = page.get_pixmap(matrix=mat, colorspace=fitz.csGRAY, alpha=False)
+                        # Usa os pixels do bitmap direto, sem codificar/decodificar PNG
+                        img = Image.frombuffer("L", (pix.width, pix.height), pix.samples,
+                                               "raw", "L", pix.stride, 1)
+                        # Libera o bitmap da página antes do OCR
+                        pix = None
+                        
+                        # Extrai texto via OCR
+                        parts.append(submit_ocr(img, pending))
+                        
+                        # Libera memória
+                        del img
                 
-                full_text += page_text + "\n"
+                page = None
                 
             except Exception as e:
                 st.warning(f"⚠️ Erro na página {page_num + 1}: {str(e)}")
                 continue
             
+            finally:
+                # Descarta recursos da página mantidos no cache do MuPDF
+                fitz.TOOLS.store_shrink(100)
+            
             progress_bar.progress((page_num + 1) / max_pages)
+            
+            # Se o texto digital lido até aqui já traz todos os campos, as
+            # páginas seguintes não precisam ser renderizadas nem ir ao OCR
+            if page_num + 1 < max_pages and fields_complete(parts, filename):
+                break
         
-        pdf_document.close()
         progress_bar.empty()
         status_text.empty()
         
-        return full_text
+        return parts
         
     except Exception as e:
         st.error(f"Erro ao processar PDF: {str(e)}")
-        return ""
+        return []
+    
+    finally:
+        if pdf_document is not None:
+            pdf_document.close()
 
 
-def extract_fields_from_text(text, filename):
+def collect_text(parts, filename):
+    """Aguarda o OCR pendente e junta o texto das partes de um arquivo"""
+    texts = []
+    for part in parts:
+        if isinstance(part, Future):
+            try:
+                part = part.result()
+            except Exception as e:
+                st.warning(f"⚠️ Erro no OCR de {filename}: {str(e)}")
+                continue
+        texts.append(part)
+    
+    return "".join(text + "\n" for text in texts)
+
+
+def extract_fields_from_text(text, filename, prioritarios=None):
     """Extrai os campos específicos usando RegEx"""
+    # Se 'prioritarios' for um set, recebe os campos preenchidos pela RegEx
+    # de maior prioridade (a primeira de cada lista)
+    if prioritarios is None:
+        prioritarios = set()
     
-    if not text or len(text.strip()) < 10:
-        st.warning(f"⚠️ Pouco texto extraído de {filename}")
+    # Remove quebras de linha e espaços extras (uma única passada, já sem
+    # espaços nas pontas)
+    text_clean = ' '.join(text.split()) if text else ''
     
-    # Remove quebras de linha e espaços extras
-    text_clean = ' '.join(text.split())
+    if len(text_clean) < 10:
+        st.warning(f"⚠️ Pouco texto extraído de {filename}")
     
     # Dicionário para armazenar os campos
     data = {
@@ -167,102 +389,95 @@ def extract_fields_from_text(text, filename):
         '10 - Nome': ''
     }
     
+    # Texto em minúsculas para localizar os rótulos com str.find/in
+    text_lower = text_clean.lower()
+    
     # RegEx para Registro ANS
-    ans_patterns = [
-        r'(?:Registro\s+ANS|ANS)[:\s]*([0-9]{5,7})',
-        r'(?:1\s*[-.\s]*Registro\s+ANS)[:\s]*([0-9]{5,7})',
-        r'(?:^|\s)([0-9]{6})(?:\s|$)',
-    ]
-    for pattern in ans_patterns:
-        match = re.search(pattern, text_clean, re.IGNORECASE)
+    for i, pattern in enumerate(ANS_PATTERNS):
+        match = pattern.search(text_clean)
         if match:
             data['1 - Registro ANS'] = match.group(1).strip()
+            if i == 0:
+                prioritarios.add('1 - Registro ANS')
             break
     
     # RegEx para Número da GUIA
-    guia_patterns = [
-        r'(?:N[úu]mero\s+(?:da\s+)?GUIA|GUIA\s+N)[:\s]*([0-9]{10,20})',
-        r'(?:2\s*[-.\s]*N[úu]mero\s+GUIA)[:\s]*([0-9]{10,20})',
-        r'(?:N[°º]\s*Guia)[:\s]*([0-9]{10,20})',
-        r'(?:GUIA)[:\s]+([0-9]{10,20})',
-    ]
-    for pattern in guia_patterns:
-        match = re.search(pattern, text_clean, re.IGNORECASE)
-        if match:
-            data['2 - Número GUIA'] = match.group(1).strip()
-            break
+    if any(anchor in text_lower for anchor in GUIA_ANCHORS):
+        for i, pattern in enumerate(GUIA_PATTERNS):
+            match = pattern.search(text_clean)
+            if match:
+                data['2 - Número GUIA'] = match.group(1).strip()
+                if i == 0:
+                    prioritarios.add('2 - Número GUIA')
+                break
     
-    # RegEx para Data de Autorização
-    data_patterns = [
-        r'(?:Data\s+(?:de\s+)?Autoriza[çc][ãa]o)[:\s]*([0-3]?[0-9][/-][0-1]?[0-9][/-][0-9]{4})',
-        r'(?:4\s*[-.\s]*Data\s+(?:de\s+)?Autoriza[çc][ãa]o)[:\s]*([0-3]?[0-9][/-][0-1]?[0-9][/-][0-9]{4})',
-        r'(?:Autoriza[çc][ãa]o)[:\s]*([0-3]?[0-9][/-][0-1]?[0-9][/-][0-9]{4})',
-    ]
-    for pattern in data_patterns:
-        match = re.search(pattern, text_clean, re.IGNORECASE)
-        if match:
-            data['4 - Data de Autorização'] = match.group(1).strip().replace('-', '/')
-            break
+    # Data de Autorização: localiza todas as datas em uma única passada e usa
+    # a que vem logo após um rótulo "Autorização" (só ':' e espaços entre
+    # eles), preferindo o rótulo completo "Data de Autorização"
+    datas = {m.start(): m.group(1) for m in DATE_RE.finditer(text_clean)}
+    if datas:
+        rotuladas = [(label.group(1) is not None, datas[label.end()])
+                     for label in AUTORIZACAO_RE.finditer(text_clean) if label.end() in datas]
+        completas = [valor for completo, valor in rotuladas if completo]
+        if completas:
+            data['4 - Data de Autorização'] = completas[0].replace('-', '/')
+            prioritarios.add('4 - Data de Autorização')
+        elif rotuladas:
+            data['4 - Data de Autorização'] = rotuladas[0][1].replace('-', '/')
     
     # RegEx para Nome
-    nome_patterns = [
-        r'(?:10\s*[-.\s]*Nome)[:\s]*([A-ZÀÁÂÃÄÅÇÈÉÊËÌÍÎÏÑÒÓÔÕÖÙÚÛÜ][A-ZÀÁÂÃÄÅÇÈÉÊËÌÍÎÏÑÒÓÔÕÖÙÚÛÜ\s]{2,50})',
-        r'(?:Nome\s+(?:do\s+)?(?:Benefici[áa]rio|Paciente))[:\s]*([A-ZÀÁÂÃÄÅÇÈÉÊËÌÍÎÏÑÒÓÔÕÖÙÚÛÜ][A-ZÀÁÂÃÄÅÇÈÉÊËÌÍÎÏÑÒÓÔÕÖÙÚÛÜ\s]{2,50})',
-        r'(?:Benefici[áa]rio)[:\s]*([A-ZÀÁÂÃÄÅÇÈÉÊËÌÍÎÏÑÒÓÔÕÖÙÚÛÜ][A-ZÀÁÂÃÄÅÇÈÉÊËÌÍÎÏÑÒÓÔÕÖÙÚÛÜ\s]{2,50})',
-    ]
-    for pattern in nome_patterns:
-        match = re.search(pattern, text_clean, re.IGNORECASE)
-        if match:
-            nome_raw = match.group(1).strip()
-            # Remove números e caracteres especiais
-            nome_clean = re.sub(r'[0-9\-/:.]+', '', nome_raw).strip()
-            # Remove espaços extras
-            nome_clean = ' '.join(nome_clean.split())
-            if len(nome_clean) >= 3:
-                data['10 - Nome'] = nome_clean
-                break
+    if any(anchor in text_lower for anchor in NOME_ANCHORS):
+        for i, pattern in enumerate(NOME_PATTERNS):
+            match = pattern.search(text_clean)
+            if match:
+                # O grupo captura só letras e espaços: basta separar as palavras
+                # e cortar no primeiro rótulo que vier logo depois do nome
+                palavras = match.group(1).split()
+                corte = next((j for j, p in enumerate(palavras) if p.lower() in NOME_STOPWORDS), len(palavras))
+                nome_clean = ' '.join(palavras[:corte])
+                if len(nome_clean) >= 3:
+                    data['10 - Nome'] = nome_clean
+                    # Um nome que chega ao fim do texto ainda pode continuar
+                    # na página seguinte
+                    if i == 0 and match.end() < len(text_clean):
+                        prioritarios.add('10 - Nome')
+                    break
     
     return data
 
 
-def process_image_file(image_file):
-    """Processa um arquivo de imagem"""
-    try:
-        img = Image.open(image_file)
-        
-        with st.spinner(f"🔍 Extraindo texto de {image_file.name}..."):
-            text = extract_text_from_image(img)
-        
-        if not text:
-            st.warning(f"⚠️ Nenhum texto foi extraído de {image_file.name}")
-        
-        return extract_fields_from_text(text, image_file.name)
-        
-    except Exception as e:
-        st.error(f"❌ Erro ao processar {image_file.name}: {str(e)}")
-        return {
-            'Arquivo': image_file.name,
-            '1 - Registro ANS': 'ERRO',
-            '2 - Número GUIA': 'ERRO',
-            '4 - Data de Autorização': 'ERRO',
-            '10 - Nome': 'ERRO'
-        }
+def fields_complete(parts, filename):
+    """Indica se o texto digital já extraído define todos os campos do documento"""
+    # Só vale para texto já disponível: não espera o OCR em andamento
+    if not all(isinstance(part, str) for part in parts):
+        return False
+    
+    text = collect_text(parts, filename)
+    if len(text.strip()) < 50:
+        return False
+    
+    # Só basta quando cada campo veio da RegEx de maior prioridade: aí
+    # nenhuma correspondência nas páginas seguintes o substituiria
+    prioritarios = set()
+    extract_fields_from_text(text, filename, prioritarios)
+    return prioritarios.issuperset(COLUNAS[1:])
 
 
-def process_pdf_file(pdf_file):
-    """Processa um arquivo PDF"""
+def process_file(file, parts):
+    """Processa um arquivo a partir das partes de texto enviadas ao OCR"""
     try:
-        text = extract_text_from_pdf(pdf_file)
+        with st.spinner(f"🔍 Extraindo texto de {file.name}..."):
+            text = collect_text(parts, file.name)
         
-        if not text:
-            st.warning(f"⚠️ Nenhum texto foi extraído de {pdf_file.name}")
+        if not text.strip():
+            st.warning(f"⚠️ Nenhum texto foi extraído de {file.name}")
         
-        return extract_fields_from_text(text, pdf_file.name)
+        return extract_fields_from_text(text, file.name)
         
     except Exception as e:
-        st.error(f"❌ Erro ao processar {pdf_file.name}: {str(e)}")
+        st.error(f"❌ Erro ao processar {file.name}: {str(e)}")
         return {
-            'Arquivo': pdf_file.name,
+            'Arquivo': file.name,
             '1 - Registro ANS': 'ERRO',
             '2 - Número GUIA': 'ERRO',
             '4 - Data de Autorização': 'ERRO',
@@ -272,11 +487,43 @@ def process_pdf_file(pdf_file):
 
 def convert_df_to_excel(df):
     """Converte DataFrame para arquivo Excel em bytes"""
+    import xlsxwriter
+    
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Guias Médicas')
-    output.seek(0)
-    return output
+    # constant_memory grava cada linha assim que ela é concluída, por isso as
+    # linhas são escritas em ordem aqui (o df.to_excel escreve por coluna).
+    # strings_to_urls=False grava o texto como está, sem testar cada célula
+    # como possível link
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True, 'strings_to_urls': False})
+    worksheet = workbook.add_worksheet('Guias Médicas')
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    
+    valores = df.fillna('').to_numpy(dtype=str)
+    
+    # Largura das colunas calculada em uma única passada sobre a tabela
+    larguras = np.char.str_len(valores).max(axis=0, initial=0)
+    for col, (nome, largura) in enumerate(zip(df.columns, larguras)):
+        worksheet.set_column(col, col, min(max(int(largura), len(nome)) + 2, 50))
+    
+    worksheet.write_row(0, 0, df.columns, header_format)
+    for row, linha in enumerate(valores, start=1):
+        worksheet.write_row(row, 0, linha)
+    
+    workbook.close()
+    return output.getvalue()
+
+
+def get_excel_bytes(df):
+    """Retorna o Excel da tabela, refeito só quando ela muda (cache da sessão)"""
+    df_hash = hashlib.blake2b(
+        pd.util.hash_pandas_object(df).to_numpy().tobytes() + repr(list(df.columns)).encode(),
+        digest_size=16
+    ).digest()
+    
+    cached = st.session_state.excel_cache
+    if cached is None or cached[0] != df_hash:
+        cached = st.session_state.excel_cache = (df_hash, convert_df_to_excel(df))
+    return cached[1]
 
 
 # Interface do Streamlit
@@ -326,22 +573,72 @@ if uploaded_files:
             # Barra de progresso geral
             overall_progress = st.progress(0)
             
-            # Processa cada arquivo
+            # Campos já extraídos, indexados pelo hash do conteúdo do arquivo
+            processed = {}
+            results_cache = st.session_state.results_cache
+            
+            # Primeiro lê todos os arquivos e envia as páginas escaneadas ao
+            # pool de OCR sem esperar o resultado: o OCR de um arquivo roda
+            # enquanto os seguintes são lidos e renderizados
+            status_text = st.empty()
+            pending = set()
+            jobs = []
+            queued_hashes = set()
             for idx, file in enumerate(uploaded_files):
+                status_text.text(f"📤 Lendo {idx + 1}/{len(uploaded_files)}: {file.name}")
+                
+                try:
+                    # Lê o conteúdo uma única vez: os mesmos bytes servem para o
+                    # hash e para abrir o PDF ou a imagem
+                    file_bytes = file.getvalue()
+                    
+                    # Arquivos com conteúdo idêntico passam pelo OCR uma única vez
+                    file_hash = hashlib.blake2b(file_bytes, digest_size=16).digest()
+                    cached = results_cache.get(file_hash)
+                    if file_hash in queued_hashes:
+                        parts = None
+                    elif cached is not None:
+                        # Já processado em uma execução anterior
+                        processed[file_hash] = cached
+                        results_cache.move_to_end(file_hash)
+                        parts = None
+                    elif file.type == "application/pdf":
+                        parts = queue_pdf_ocr(file_bytes, file.name, pending)
+                    else:
+                        parts = queue_image_ocr(file_bytes, pending)
+                    queued_hashes.add(file_hash)
+                except Exception as e:
+                    file_hash, parts = None, e
+                
+                jobs.append((file, file_hash, parts))
+            
+            status_text.empty()
+            
+            # Junta o texto de cada arquivo, na ordem do upload
+            for idx, (file, file_hash, parts) in enumerate(jobs):
                 st.write(f"**Processando {idx + 1}/{len(uploaded_files)}: {file.name}**")
                 
                 try:
-                    if file.type == "application/pdf":
-                        data = process_pdf_file(file)
+                    if isinstance(parts, Exception):
+                        raise parts
+                    
+                    if file_hash in processed:
+                        data = dict(processed[file_hash], Arquivo=file.name)
+                        st.info(f"♻️ {file.name} já foi processado, resultado reaproveitado")
                     else:
-                        data = process_image_file(file)
+                        data = process_file(file, parts)
                     
+                    processed.setdefault(file_hash, data)
                     results.append(data)
                     
                     # Verifica se extraiu pelo menos um campo
                     campos_extraidos = sum(1 for k, v in data.items() if k != 'Arquivo' and v and v != 'ERRO')
                     if campos_extraidos > 0:
                         st.success(f"✓ {file.name} - {campos_extraidos} campo(s) extraído(s)")
+                        # Só resultados com campos vão para o cache, para que
+                        # falhas (ex.: OCR indisponível) sejam refeitas
+                        if parts is not None:
+                            cache_results(file_hash, data)
                     else:
                         st.warning(f"⚠️ {file.name} - Nenhum campo extraído")
                     
@@ -359,9 +656,15 @@ if uploaded_files:
             
             overall_progress.empty()
             
+            # Os bitmaps já foram liberados página a página; uma única coleta
+            # recolhe o que sobrou em ciclos após o lote inteiro
+            del jobs
+            gc.collect()
+            
             # Cria DataFrame
             if results:
-                df = pd.DataFrame(results)
+                # Monta as colunas diretamente, já na ordem da tabela
+                df = pd.DataFrame({col: [row.get(col, '') for row in results] for col in COLUNAS})
                 st.session_state.df_results = df
                 st.balloons()
                 st.success("🎉 Processamento concluído!")
@@ -391,7 +694,7 @@ if 'df_results' in st.session_state:
     col1, col2, col3 = st.columns([1, 2, 1])
     
     with col2:
-        excel_file = convert_df_to_excel(edited_df)
+        excel_file = get_excel_bytes(edited_df)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
         st.download_button(
@@ -405,18 +708,21 @@ if 'df_results' in st.session_state:
     
     # Estatísticas
     st.divider()
+    
+    # Conta os campos preenchidos de todas as colunas em uma única passada
+    campos = edited_df.drop(columns=['Arquivo']).fillna('')
+    valores = np.char.strip(campos.to_numpy(dtype=str))
+    preenchidos = dict(zip(campos.columns, ((valores != '') & (valores != 'ERRO')).sum(axis=0)))
+    
     col1, col2, col3, col4 = st.columns(4)
     with col1:
         st.metric("Total de Guias", len(edited_df))
     with col2:
-        ans_preenchidos = edited_df['1 - Registro ANS'].astype(str).str.strip().ne('').ne('ERRO').sum()
-        st.metric("ANS Extraídos", f"{ans_preenchidos}/{len(edited_df)}")
+        st.metric("ANS Extraídos", f"{preenchidos['1 - Registro ANS']}/{len(edited_df)}")
     with col3:
-        guia_preenchidos = edited_df['2 - Número GUIA'].astype(str).str.strip().ne('').ne('ERRO').sum()
-        st.metric("GUIA Extraídos", f"{guia_preenchidos}/{len(edited_df)}")
+        st.metric("GUIA Extraídos", f"{preenchidos['2 - Número GUIA']}/{len(edited_df)}")
     with col4:
-        nome_preenchidos = edited_df['10 - Nome'].astype(str).str.strip().ne('').ne('ERRO').sum()
-        st.metric("Nomes Extraídos", f"{nome_preenchidos}/{len(edited_df)}")
+        st.metric("Nomes Extraídos", f"{preenchidos['10 - Nome']}/{len(edited_df)}")
 
 # Rodapé
 st.divider()